@@ -1,22 +1,42 @@
 from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from gotrue.types import User
+from gotrue.errors import AuthApiError
+from PIL import Image, ImageOps
+from postgrest.exceptions import APIError
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from urllib.parse import urljoin, urlparse
+import asyncio
+import base64
+import bisect
+import hashlib
+import heapq
+import httpx
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import math
 import os
+import random
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
 
 
 app = FastAPI()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for now - should be configured properly for production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Explicit host and port configuration
 import uvicorn
 if __name__ == "__main__":
@@ -32,18 +52,1513 @@ if not url or not key:
 
 supabase: Client = create_client(url, key)
 
+logger = logging.getLogger("glich")
+
+# Upstream resilience: every Supabase call goes through run_upstream, which runs the blocking
+# client off the event loop with a timeout and trips a circuit breaker after repeated failures.
+UPSTREAM_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_TIMEOUT_SECONDS", "5"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "15"))
+
+class UpstreamUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            # Let a single trial request through to find out whether upstream has recovered
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def release_probe(self):
+        # The trial request ended without telling us anything (e.g. it was cancelled)
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+supabase_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+
+# Per-request list of upstream call timings; None (and untouched) unless the request is traced
+upstream_trace: ContextVar = ContextVar("upstream_trace", default=None)
+
+def describe_upstream_call(call) -> str:
+    # "GET calls" for PostgREST builders, the function name for anything else
+    request = getattr(getattr(call, "__self__", None), "request", None)
+    path = getattr(request, "path", None)
+    if path is not None:
+        method = getattr(request.http_method, "value", request.http_method)
+        return f"{method} {str(path).rsplit('/', 1)[-1]}"
+    return getattr(call, "__qualname__", "upstream")
+
+async def run_upstream(call, timeout: float = UPSTREAM_TIMEOUT_SECONDS, label: str = None):
+    trace = upstream_trace.get()
+    if trace is None:
+        return await _call_upstream(call, timeout)
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        return await _call_upstream(call, timeout)
+    except BaseException as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        trace.append({
+            "call": label or describe_upstream_call(call),
+            "ms": round((time.perf_counter() - started) * 1000, 2),
+            "outcome": outcome,
+        })
+
+# Error answers that mean Supabase (or the gateway in front of it) is struggling, not that the
+# request was wrong
+UPSTREAM_FAILURE_STATUSES = {408, 429}
+
+def is_upstream_failure(e: Exception) -> bool:
+    # APIError.code is the HTTP status for non-JSON (gateway) bodies and a Postgres/PostgREST code
+    # otherwise; the latter are five characters or prefixed, so they never parse as a 3-digit status
+    status = e.status if isinstance(e, AuthApiError) else e.code
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    return 500 <= status <= 599 or status in UPSTREAM_FAILURE_STATUSES
+
+async def _call_upstream(call, timeout: float):
+    probe = supabase_breaker.state == "half-open"
+    if not supabase_breaker.allow():
+        raise UpstreamUnavailable("Supabase is unavailable (circuit open)")
+    try:
+        result = await asyncio.wait_for(asyncio.to_thread(call), timeout)
+    except (APIError, AuthApiError) as e:
+        # A 4xx means upstream answered and is healthy; 5xx/408/429 count against it
+        if is_upstream_failure(e):
+            supabase_breaker.record_failure()
+        else:
+            supabase_breaker.record_success()
+        raise
+    except asyncio.TimeoutError:
+        supabase_breaker.record_failure()
+        raise UpstreamUnavailable(f"Supabase did not respond within {timeout}s")
+    except Exception:
+        supabase_breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled (client disconnect, lost hedge, aborted export): if this was the half-open
+        # probe, free the slot or the circuit would never get another trial request
+        if probe:
+            supabase_breaker.release_probe()
+        raise
+    supabase_breaker.record_success()
+    return result
+
+# Hedged reads: for idempotent queries that opt in with a hedge_key, a duplicate request is
+# fired once the primary has been outstanding longer than that route's observed p95, and
+# the first successful answer wins. Hedges spend from a token bucket that refills by
+# HEDGE_BUDGET_RATIO per hedgeable request, capping extra load at roughly that fraction.
+HEDGE_BUDGET_RATIO = float(os.environ.get("HEDGE_BUDGET_RATIO", "0.05"))
+HEDGE_BUDGET_BURST = 10
+HEDGE_SAMPLE_SIZE = 500
+HEDGE_MIN_SAMPLES = 50
+
+class HedgedRoute:
+    def __init__(self):
+        self.samples = deque(maxlen=HEDGE_SAMPLE_SIZE)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._p95 = None
+        self._p95_stale = True
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self._p95_stale = True
+
+    def p95(self):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._p95_stale:
+            ordered = sorted(self.samples)
+            self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+            self._p95_stale = False
+        return self._p95
+
+hedged_routes: dict = {}
+hedge_budget = float(HEDGE_BUDGET_BURST)
+
+async def run_hedged(call, hedge_key: str, timeout: float = UPSTREAM_TIMEOUT_SECONDS, label: str = None):
+    global hedge_budget
+    # Hedged calls are lambdas, so they're traced under an explicit label rather than a function name
+    label = label or hedge_key
+    route = hedged_routes.setdefault(hedge_key, HedgedRoute())
+    route.requests += 1
+    hedge_budget = min(HEDGE_BUDGET_BURST, hedge_budget + HEDGE_BUDGET_RATIO)
+
+    # Latencies are measured from the primary's start, hedge or not: that's what the caller waited
+    started = time.monotonic()
+    primary = asyncio.ensure_future(run_upstream(call, timeout, label))
+    hedge = None
+    delay = route.p95()
+    if delay is not None:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if not done and hedge_budget >= 1:
+            hedge_budget -= 1
+            route.hedges += 1
+            hedge = asyncio.ensure_future(run_upstream(call, timeout, f"{label} (hedge)"))
+
+    pending = {primary, hedge} - {None}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                route.record(time.monotonic() - started)
+                if task is hedge:
+                    route.hedge_wins += 1
+                return task.result()
+        raise error
+    finally:
+        for task in pending:
+            if task is primary:
+                # Let a slow primary finish so its latency is sampled too; otherwise the samples
+                # would only ever see the faster hedges and p95 would drift down
+                task.add_done_callback(lambda task: record_primary(route, task, started))
+            else:
+                # The losing request's worker thread can't be interrupted, but its result is dropped
+                task.cancel()
+
+def record_primary(route: HedgedRoute, task: asyncio.Future, started: float):
+    if not task.cancelled() and task.exception() is None:
+        route.record(time.monotonic() - started)
+
+# Stale-while-revalidate cache for idempotent reads. Entries younger than READ_CACHE_FRESH_SECONDS
+# are served as-is; older ones are served immediately while a background refresh runs, and
+# during an upstream outage the last good result is served for up to READ_CACHE_STALE_SECONDS.
+READ_CACHE_FRESH_SECONDS = float(os.environ.get("READ_CACHE_FRESH_SECONDS", "5"))
+READ_CACHE_STALE_SECONDS = float(os.environ.get("READ_CACHE_STALE_SECONDS", "600"))
+READ_CACHE_MAX_ENTRIES = 10000
+
+class ReadCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.revalidating = {}
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value):
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, prefix: str):
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+
+    def revalidate(self, key: str, fetch):
+        if key in self.revalidating:
+            return
+
+        async def refresh():
+            try:
+                self.put(key, await fetch())
+            except Exception:
+                logger.warning("Background revalidation of %s failed", key, exc_info=True)
+            finally:
+                self.revalidating.pop(key, None)
+
+        self.revalidating[key] = asyncio.create_task(refresh())
+
+read_cache = ReadCache(READ_CACHE_MAX_ENTRIES)
+# Verified access tokens, so authenticated reads keep working while Supabase auth is unreachable
+AUTH_CACHE_FRESH_SECONDS = 60
+auth_cache = ReadCache(READ_CACHE_MAX_ENTRIES)
+
+def set_cache_headers(response: Response, status: str, age: float, warning: str = None):
+    response.headers["X-Cache"] = status
+    response.headers["Age"] = str(int(age))
+    if warning:
+        response.headers["Warning"] = warning
+
+def fetch_rows(build_query, hedge_key: str = None):
+    # Builds a fresh query on every call so background revalidations and hedges don't share builder state
+    async def fetch():
+        if hedge_key is None:
+            result = await run_upstream(build_query().execute)
+        else:
+            result = await run_hedged(lambda: build_query().execute(), hedge_key)
+        return result.data or []
+    return fetch
+
+async def cached_read(key: str, fetch, response: Response):
+    entry = read_cache.get(key)
+    if entry is not None:
+        value, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age < READ_CACHE_FRESH_SECONDS:
+            set_cache_headers(response, "HIT", age)
+            return value
+        if age < READ_CACHE_STALE_SECONDS and supabase_breaker.state != "closed":
+            # Don't queue work behind an open circuit; keep serving what we have
+            set_cache_headers(response, "STALE", age, '111 - "Revalidation Failed"')
+            return value
+        if age < READ_CACHE_STALE_SECONDS:
+            read_cache.revalidate(key, fetch)
+            set_cache_headers(response, "STALE", age, '110 - "Response is Stale"')
+            return value
+
+    try:
+        value = await fetch()
+    except Exception as e:
+        if entry is None or (isinstance(e, (APIError, AuthApiError)) and not is_upstream_failure(e)):
+            raise
+        # Stale-if-error: the last good result beats an error page during an outage
+        set_cache_headers(response, "STALE", time.monotonic() - entry[1], '111 - "Revalidation Failed"')
+        return entry[0]
+    read_cache.put(key, value)
+    set_cache_headers(response, "MISS", 0)
+    return value
+
 async def get_current_user(request: Request) -> User:
     token = request.cookies.get("sb-access-token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
+    cached = auth_cache.get(token)
+    if cached is not None and time.monotonic() - cached[1] < AUTH_CACHE_FRESH_SECONDS and not access_token_expired(token):
+        return cached[0]
+
     try:
-        user_response = supabase.auth.get_user(token)
+        user_response = await run_upstream(lambda: supabase.auth.get_user(token), label="auth get_user")
         if user_response.user:
+            auth_cache.put(token, user_response.user)
             return user_response.user
         raise HTTPException(status_code=401, detail="Invalid or expired token")
-    except Exception as e:
+    except HTTPException:
+        raise
+    except AuthApiError as e:
+        if is_upstream_failure(e):
+            if cached is not None and not access_token_expired(token):
+                return cached[0]
+            raise HTTPException(status_code=503, detail="Authentication service unavailable")
+        # Supabase looked at the token and rejected it
         raise HTTPException(status_code=401, detail=f"Token verification failed: {str(e)}")
+    except Exception as e:
+        # Circuit open, timeout or transport error: says nothing about the token
+        if cached is not None and not access_token_expired(token):
+            return cached[0]
+        # Not the user's fault; a 401 here would bounce them back through OAuth
+        raise HTTPException(status_code=503, detail=str(e) if isinstance(e, UpstreamUnavailable) else "Authentication service unavailable")
+
+REFRESH_TOKEN_MAX_AGE = 604800
+# Refresh this many seconds before the access token actually expires
+ACCESS_TOKEN_REFRESH_LEEWAY = 30
+# How long a finished refresh is reused for requests still carrying the old refresh token
+SESSION_REFRESH_REUSE_SECONDS = 10
+
+def set_session_cookies(response: Response, session):
+    response.set_cookie(
+        key="sb-access-token", value=session.access_token, httponly=True, samesite="lax",
+        secure=False, max_age=session.expires_in
+    )
+    response.set_cookie(
+        key="sb-refresh-token", value=session.refresh_token, httponly=True, samesite="lax",
+        secure=False, max_age=REFRESH_TOKEN_MAX_AGE
+    )
+
+def access_token_expired(token: str) -> bool:
+    # Only reads the exp claim; the signature is still verified by supabase.auth.get_user
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return claims["exp"] - ACCESS_TOKEN_REFRESH_LEEWAY <= time.time()
+    except Exception:
+        return False
+
+# In-flight and recently finished refreshes keyed by refresh token, so that a burst of
+# requests arriving with the same expired session triggers a single upstream refresh
+_session_refreshes: dict = {}
+
+def request_session_refresh(refresh_token: str):
+    # Goes straight to GoTrue rather than through supabase.auth.refresh_session: that would store
+    # the user's session on the shared client and switch every later PostgREST query to their JWT
+    response = httpx.post(
+        f"{url}/auth/v1/token",
+        params={"grant_type": "refresh_token"},
+        headers={"apikey": key, "Authorization": f"Bearer {key}"},
+        json={"refresh_token": refresh_token},
+        timeout=UPSTREAM_TIMEOUT_SECONDS,
+    )
+    if 400 <= response.status_code < 500:
+        try:
+            error = response.json()
+        except ValueError:
+            error = {}
+        raise AuthApiError(
+            error.get("error_description") or error.get("msg") or "Refresh token rejected",
+            response.status_code,
+            error.get("error_code") or error.get("error"),
+        )
+    response.raise_for_status()
+    session = response.json()
+    return SimpleNamespace(
+        access_token=session["access_token"],
+        refresh_token=session["refresh_token"],
+        expires_in=session["expires_in"],
+    )
+
+async def refresh_session_coalesced(refresh_token: str):
+    task = _session_refreshes.get(refresh_token)
+    if task is None:
+        task = asyncio.ensure_future(run_upstream(lambda: request_session_refresh(refresh_token), label="auth refresh_session"))
+        _session_refreshes[refresh_token] = task
+        task.add_done_callback(lambda task: forget_session_refresh(refresh_token, task))
+    return await asyncio.shield(task)
+
+def forget_session_refresh(refresh_token: str, task: asyncio.Future):
+    # New sessions and outright rejections are reused for a while; anything else (timeouts,
+    # outages, cancellation) is dropped at once so the next request retries
+    if not task.cancelled():
+        error = task.exception()
+        rejected = isinstance(error, AuthApiError) and not is_upstream_failure(error)
+        if error is None or rejected:
+            asyncio.get_running_loop().call_later(SESSION_REFRESH_REUSE_SECONDS, _session_refreshes.pop, refresh_token, None)
+            return
+    _session_refreshes.pop(refresh_token, None)
+
+@app.middleware("http")
+async def refresh_expired_session(request: Request, call_next):
+    access_token = request.cookies.get("sb-access-token")
+    refresh_token = request.cookies.get("sb-refresh-token")
+    # The access cookie's max_age matches the token lifetime, so an expired session usually
+    # arrives with only the refresh cookie
+    if (
+        request.url.path.startswith("/api/auth/")
+        or not refresh_token
+        or (access_token and not access_token_expired(access_token))
+    ):
+        return await call_next(request)
+
+    try:
+        session = await refresh_session_coalesced(refresh_token)
+    except AuthApiError as e:
+        if is_upstream_failure(e):
+            logger.warning("Session refresh failed", exc_info=True)
+            return JSONResponse({"detail": f"Could not refresh the session: {str(e)}"}, status_code=503)
+        # GoTrue rejected the refresh token itself: the session really is over
+        logger.warning("Session refresh rejected", exc_info=True)
+        session = None
+    except Exception as e:
+        # Timeouts, an open circuit or a transport error: keep the cookies, the session is
+        # probably still good once Supabase is reachable again
+        logger.warning("Session refresh failed", exc_info=True)
+        return JSONResponse({"detail": f"Could not refresh the session: {str(e)}"}, status_code=503)
+
+    if session is None:
+        response = await call_next(request)
+        response.delete_cookie(key="sb-access-token")
+        response.delete_cookie(key="sb-refresh-token")
+        return response
+
+    # Hand the fresh access token to the handler as if the browser had sent it
+    cookies = dict(request.cookies, **{"sb-access-token": session.access_token, "sb-refresh-token": session.refresh_token})
+    cookie_header = "; ".join(f"{name}={value}" for name, value in cookies.items())
+    request.scope["headers"] = [
+        (name, value) for name, value in request.scope["headers"] if name != b"cookie"
+    ] + [(b"cookie", cookie_header.encode("latin-1"))]
+
+    response = await call_next(request)
+    set_session_cookies(response, session)
+    return response
+
+# Idempotency keys: a retried write carrying the same Idempotency-Key gets the stored response
+# of the first attempt instead of running again, and a duplicate that arrives while the first
+# is still running waits for it. Keys are scoped to the caller's session cookie.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = 10000
+IDEMPOTENT_METHODS = {"POST", "PUT", "DELETE"}
+
+# (session hash, key) -> {"fingerprint", "status", "headers", "body", "expires_at"}
+idempotent_responses: OrderedDict = OrderedDict()
+# (session hash, key) -> Future resolved when the first attempt finishes
+idempotent_in_flight: dict = {}
+
+def store_idempotent_response(store_key: tuple, entry: dict):
+    now = time.monotonic()
+    idempotent_responses[store_key] = entry
+    idempotent_responses.move_to_end(store_key)
+    while idempotent_responses and (
+        len(idempotent_responses) > IDEMPOTENCY_MAX_ENTRIES
+        or next(iter(idempotent_responses.values()))["expires_at"] <= now
+    ):
+        idempotent_responses.popitem(last=False)
+
+def response_from_parts(status: int, raw_headers: list, body: bytes) -> Response:
+    response = Response(content=body, status_code=status)
+    # Raw headers keep repeated ones such as Set-Cookie intact
+    response.raw_headers = [(name, value) for name, value in raw_headers if name != b"content-length"]
+    response.raw_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+    return response
+
+@app.middleware("http")
+async def deduplicate_idempotent_writes(request: Request, call_next):
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if not idempotency_key or request.method not in IDEMPOTENT_METHODS or request.url.path.startswith("/api/auth/"):
+        return await call_next(request)
+
+    session = request.cookies.get("sb-access-token") or request.cookies.get("sb-refresh-token") or ""
+    store_key = (hashlib.sha256(session.encode()).hexdigest(), idempotency_key)
+    body = await request.body()
+    fingerprint = hashlib.sha256(
+        b"\0".join([request.method.encode(), request.url.path.encode(), request.url.query.encode(), body])
+    ).hexdigest()
+
+    while True:
+        entry = idempotent_responses.get(store_key)
+        if entry is not None and entry["expires_at"] > time.monotonic():
+            if entry["fingerprint"] != fingerprint:
+                return JSONResponse({"detail": "Idempotency-Key was already used for a different request."}, status_code=422)
+            response = response_from_parts(entry["status"], entry["headers"], entry["body"])
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        in_flight = idempotent_in_flight.get(store_key)
+        if in_flight is None:
+            break
+        # Another attempt with this key is running; wait for it, then replay or retry ourselves
+        await asyncio.shield(in_flight)
+
+    in_flight = idempotent_in_flight[store_key] = asyncio.get_running_loop().create_future()
+    try:
+        response = await call_next(request)
+        if response.status_code >= 500:
+            # Transient failures aren't stored, so the client's next retry really retries
+            return response
+        content = b"".join([chunk async for chunk in response.body_iterator])
+        store_idempotent_response(store_key, {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "headers": response.raw_headers,
+            "body": content,
+            "expires_at": time.monotonic() + IDEMPOTENCY_TTL_SECONDS,
+        })
+        return response_from_parts(response.status_code, response.raw_headers, content)
+    finally:
+        del idempotent_in_flight[store_key]
+        in_flight.set_result(None)
+
+# Request diagnostics. Requests slower than SLOW_REQUEST_MS are logged with a breakdown of
+# their upstream calls. A request can also be profiled by a sampling profiler, either on demand
+# (X-Profile: 1 plus the admin token) or at random with PROFILE_SAMPLE_RATE; profiles are kept
+# in folded-stack format, which flamegraph.pl and speedscope read directly. Everything here is off
+# by default; switching any of it on wraps every request in one more middleware layer and records
+# each upstream call, which costs a little latency on every request, not just the slow ones.
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_SECONDS = 0.005
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+DIAGNOSTICS_HISTORY = 100
+# Upstream query budget: requests making more Supabase calls than their route's budget are logged,
+# as are requests repeating the same call N_PLUS_ONE_THRESHOLD or more times (a likely N+1).
+UPSTREAM_QUERY_BUDGET = int(os.environ.get("UPSTREAM_QUERY_BUDGET", "0"))
+ROUTE_QUERY_BUDGETS = {
+    # The auth check plus four interaction tables
+    "/api/calls/{post_id}/interactions": 5,
+    "/api/export": 1000,
+}
+N_PLUS_ONE_THRESHOLD = 4
+# Routes that page through a table, where repeating the same query is the point
+PAGED_ROUTES = {"/api/export"}
+
+slow_requests: deque = deque(maxlen=DIAGNOSTICS_HISTORY)
+request_profiles: OrderedDict = OrderedDict()
+
+def is_admin_request(request: Request) -> bool:
+    return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+class StackSampler:
+    # Samples one thread's stack on a timer from a helper thread. Handlers run on the event loop
+    # thread, so concurrent requests can show up in the profile too.
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+async def diagnose_request(request: Request, call_next):
+    profile = (request.headers.get("X-Profile") == "1" and is_admin_request(request)) or (
+        PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    )
+    trace = []
+    token = upstream_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        if profile:
+            with StackSampler(threading.get_ident(), PROFILE_INTERVAL_SECONDS) as sampler:
+                response = await call_next(request)
+        else:
+            response = await call_next(request)
+    finally:
+        upstream_trace.reset(token)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    entry = {
+        "method": request.method,
+        "path": request.url.path,
+        "status": response.status_code,
+        "ms": round(elapsed_ms, 2),
+        "upstream_ms": round(sum(call["ms"] for call in trace), 2),
+        "upstream": trace,
+        "at": time.time(),
+    }
+    upstream_ms = sum(call["ms"] for call in trace)
+    timings = [f'upstream;dur={upstream_ms:.1f};desc="{len(trace)} calls"', f"app;dur={elapsed_ms - upstream_ms:.1f}"]
+    # Per-call entries name tables and filters, so only admins get them
+    if is_admin_request(request):
+        timings += [f'db{i};dur={call["ms"]};desc="{call["call"]}"' for i, call in enumerate(trace)]
+    response.headers["Server-Timing"] = ", ".join(timings)
+    if UPSTREAM_QUERY_BUDGET:
+        # Streamed bodies (the export) make their upstream calls after call_next returns, so the
+        # budget is checked once the body has been sent
+        response.body_iterator = check_query_budget_after(response.body_iterator, request, trace)
+
+    if SLOW_REQUEST_MS and elapsed_ms >= SLOW_REQUEST_MS:
+        slow_requests.append(entry)
+        logger.warning("Slow request: %s", json.dumps(entry))
+    if profile:
+        profile_id = uuid.uuid4().hex
+        request_profiles[profile_id] = dict(entry, folded=sampler.folded())
+        while len(request_profiles) > DIAGNOSTICS_HISTORY:
+            request_profiles.popitem(last=False)
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
+async def check_query_budget_after(body, request: Request, trace: list):
+    async for chunk in body:
+        yield chunk
+    check_query_budget(request, trace)
+
+def check_query_budget(request: Request, trace: list):
+    route = request.scope.get("route")
+    route_path = getattr(route, "path", request.url.path)
+    budget = ROUTE_QUERY_BUDGETS.get(route_path, UPSTREAM_QUERY_BUDGET)
+    if len(trace) > budget:
+        logger.warning(
+            "%s %s made %d upstream calls (budget %d): %s",
+            request.method, route_path, len(trace), budget, ", ".join(call["call"] for call in trace),
+        )
+    if route_path in PAGED_ROUTES:
+        return
+    for call, count in Counter(call["call"] for call in trace).items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            logger.warning("Possible N+1 in %s %s: %s called %d times", request.method, route_path, call, count)
+
+# Only installed when something is switched on, so a disabled setup pays nothing per request
+if SLOW_REQUEST_MS or PROFILE_SAMPLE_RATE or ADMIN_TOKEN or UPSTREAM_QUERY_BUDGET:
+    app.middleware("http")(diagnose_request)
+
+# Added last so it is the outermost layer: responses the middlewares above build themselves
+# (idempotency 422/replays, refresh 503s) get CORS headers too
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allow all origins for now - should be configured properly for production
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Username availability: an in-process Bloom filter of every known username so that
+# keystroke-by-keystroke availability probes only hit the database on a possible match.
+USERNAME_FILTER_FP_RATE = float(os.environ.get("USERNAME_FILTER_FP_RATE", "0.01"))
+USERNAME_FILTER_MIN_CAPACITY = 10000
+USERNAME_FILTER_REFRESH_SECONDS = int(os.environ.get("USERNAME_FILTER_REFRESH_SECONDS", "300"))
+FETCH_PAGE_SIZE = 1000
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, int(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Kirsch-Mitzenmacher double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+# None until the first load finishes; availability checks fall back to exact lookups meanwhile
+username_filter: BloomFilter | None = None
+
+# Prefix autocomplete over usernames: a sorted array of lowercased usernames searched with
+# bisect, plus precomputed top-ranked lists for short prefixes and any prefix with a large range.
+AUTOCOMPLETE_TOP_PREFIX_LENGTH = 3
+AUTOCOMPLETE_TOP_SIZE = 20
+AUTOCOMPLETE_MAX_LIMIT = AUTOCOMPLETE_TOP_SIZE
+AUTOCOMPLETE_SCAN_LIMIT = 256
+
+class UsernameIndex:
+    def __init__(self, profiles: list, popularity: dict):
+        self.popularity = popularity
+        self.profiles = {}
+        self.top = {}
+        for profile in profiles:
+            if profile.get("username"):
+                self.profiles[profile["user_id"]] = {
+                    "user_id": profile["user_id"],
+                    "username": profile["username"],
+                    "avatar_url": profile.get("avatar_url"),
+                }
+        self.keys = sorted((p["username"].lower(), user_id) for user_id, p in self.profiles.items())
+        for name, user_id in self.keys:
+            for i in range(1, min(len(name), AUTOCOMPLETE_TOP_PREFIX_LENGTH) + 1):
+                self.top.setdefault(name[:i], []).append(user_id)
+        for prefix, user_ids in self.top.items():
+            user_ids.sort(key=self._rank)
+            del user_ids[AUTOCOMPLETE_TOP_SIZE:]
+
+    def _rank(self, user_id: str):
+        return (-self.popularity.get(user_id, 0), self.profiles[user_id]["username"].lower())
+
+    def _ranked_prefixes(self, name: str):
+        # Prefixes of this name that keep a precomputed ranking
+        for i in range(1, len(name) + 1):
+            if i <= AUTOCOMPLETE_TOP_PREFIX_LENGTH or name[:i] in self.top:
+                yield name[:i]
+
+    def _promote(self, name: str, user_id: str):
+        for prefix in self._ranked_prefixes(name):
+            user_ids = self.top.setdefault(prefix, [])
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+            user_ids.sort(key=self._rank)
+            del user_ids[AUTOCOMPLETE_TOP_SIZE:]
+
+    def _demote(self, name: str, user_id: str):
+        for prefix in self._ranked_prefixes(name):
+            user_ids = self.top.get(prefix, [])
+            if user_id in user_ids:
+                # Refill the freed slot from the sorted range so the list stays complete
+                user_ids[:] = heapq.nsmallest(AUTOCOMPLETE_TOP_SIZE, self._range(prefix), key=self._rank)
+
+    def _bounds(self, prefix: str):
+        return bisect.bisect_left(self.keys, (prefix,)), bisect.bisect_left(self.keys, (prefix + "\uffff",))
+
+    def _range(self, prefix: str):
+        lo, hi = self._bounds(prefix)
+        return (self.keys[i][1] for i in range(lo, hi))
+
+    def upsert(self, profile: dict):
+        user_id, username = profile.get("user_id"), profile.get("username")
+        if not user_id or not username:
+            return
+        old = self.profiles.get(user_id)
+        if old and old["username"].lower() != username.lower():
+            old_name = old["username"].lower()
+            del self.keys[bisect.bisect_left(self.keys, (old_name, user_id))]
+            del self.profiles[user_id]
+            self._demote(old_name, user_id)
+            old = None
+        self.profiles[user_id] = {"user_id": user_id, "username": username, "avatar_url": profile.get("avatar_url", old and old["avatar_url"])}
+        if old is None:
+            bisect.insort(self.keys, (username.lower(), user_id))
+        self._promote(username.lower(), user_id)
+
+    def bump(self, user_id: str, amount: int = 1):
+        self.popularity[user_id] = self.popularity.get(user_id, 0) + amount
+        if user_id in self.profiles:
+            self._promote(self.profiles[user_id]["username"].lower(), user_id)
+
+    def search(self, prefix: str, limit: int) -> list:
+        prefix = prefix.lower()
+        if prefix in self.top or len(prefix) <= AUTOCOMPLETE_TOP_PREFIX_LENGTH:
+            user_ids = self.top.get(prefix, [])[:limit]
+        else:
+            lo, hi = self._bounds(prefix)
+            user_ids = heapq.nsmallest(AUTOCOMPLETE_TOP_SIZE, self._range(prefix), key=self._rank)
+            if hi - lo > AUTOCOMPLETE_SCAN_LIMIT:
+                # Large range: remember its ranking so the next keystroke is a dict lookup
+                self.top[prefix] = user_ids
+            user_ids = user_ids[:limit]
+        return [dict(self.profiles[user_id], popularity=self.popularity.get(user_id, 0)) for user_id in user_ids]
+
+username_index: UsernameIndex | None = None
+# Profiles written while a reload is in flight, replayed into the new indexes before they are swapped in
+_pending_profiles: list | None = None
+# The reload in flight, if any: the capacity-triggered rebuild and the periodic refresh share it
+_profile_index_load: asyncio.Future | None = None
+
+def fetch_all_rows(table: str, columns: str, key: str) -> list:
+    # Keyset pagination: constant cost per page regardless of how deep into the table we are
+    rows = []
+    last_key = None
+    while True:
+        query = supabase.table(table).select(columns).order(key).limit(FETCH_PAGE_SIZE)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        page = query.execute().data or []
+        rows.extend(page)
+        if len(page) < FETCH_PAGE_SIZE:
+            return rows
+        last_key = page[-1][key]
+
+def fetch_username_popularity() -> dict:
+    # Number of calls authored, used to rank autocomplete suggestions
+    popularity = {}
+    for row in fetch_all_rows("calls", "id, user_id", "id"):
+        popularity[row["user_id"]] = popularity.get(row["user_id"], 0) + 1
+    return popularity
+
+def build_profile_indexes():
+    profiles = fetch_all_rows("profiles", "user_id, username, avatar_url", "user_id")
+    popularity = username_index.popularity if username_index is not None else fetch_username_popularity()
+    bloom = BloomFilter(max(len(profiles) * 2, USERNAME_FILTER_MIN_CAPACITY), USERNAME_FILTER_FP_RATE)
+    for profile in profiles:
+        if profile.get("username"):
+            bloom.add(profile["username"])
+    return bloom, UsernameIndex(profiles, popularity)
+
+async def reload_profile_indexes():
+    # Built in a worker thread; the replay and swap happen here on the event loop, where
+    # index_profile runs, so no write can land between them
+    global username_filter, username_index, _pending_profiles
+    _pending_profiles = []
+    try:
+        bloom, index = await asyncio.to_thread(build_profile_indexes)
+        for profile in _pending_profiles:
+            bloom.add(profile["username"])
+            index.upsert(profile)
+        username_filter, username_index = bloom, index
+    finally:
+        _pending_profiles = None
+
+def load_profile_indexes() -> asyncio.Future:
+    global _profile_index_load
+    if _profile_index_load is None or _profile_index_load.done():
+        _profile_index_load = asyncio.ensure_future(reload_profile_indexes())
+    return _profile_index_load
+
+def log_profile_index_failure(load: asyncio.Future):
+    if not load.cancelled() and load.exception() is not None:
+        logger.error("Failed to rebuild the profile indexes", exc_info=load.exception())
+
+def index_profile(profile: dict):
+    if not profile.get("username"):
+        return
+    if _pending_profiles is not None:
+        _pending_profiles.append(profile)
+    if username_index is not None:
+        username_index.upsert(profile)
+    if username_filter is None:
+        return
+    username_filter.add(profile["username"])
+    if username_filter.count > username_filter.capacity and (_profile_index_load is None or _profile_index_load.done()):
+        # Past capacity the false-positive rate climbs quickly; rebuild at a larger size
+        load_profile_indexes().add_done_callback(log_profile_index_failure)
+
+async def refresh_profile_indexes_periodically():
+    # Profiles are also created outside this process (e.g. the on_auth_user_created trigger)
+    while True:
+        await asyncio.sleep(USERNAME_FILTER_REFRESH_SECONDS)
+        try:
+            await load_profile_indexes()
+        except Exception:
+            logger.exception("Failed to refresh the profile indexes")
+
+@app.on_event("startup")
+async def start_profile_indexes():
+    try:
+        await load_profile_indexes()
+    except Exception:
+        logger.exception("Failed to load the profile indexes; falling back to database lookups")
+    asyncio.create_task(refresh_profile_indexes_periodically())
+
+# Trending calls: scores are sums of weighted interactions, each scaled by 2^((t - epoch) / half_life).
+# Because every score shares the same epoch, older calls decay relative to newer ones without
+# ever being recomputed, so the background job only has to fold in interactions it hasn't seen.
+TRENDING_WEIGHTS = {"amplifies": 1.0, "echoes": 2.0, "responses": 3.0}
+TRENDING_HALF_LIFE_SECONDS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", "6")) * 3600
+TRENDING_WINDOW_SECONDS = 7 * 24 * 3600
+TRENDING_REFRESH_SECONDS = int(os.environ.get("TRENDING_REFRESH_SECONDS", "60"))
+TRENDING_MAX_PAGE_SIZE = 50
+# Scores are rebased before the exponent gets anywhere near float overflow
+TRENDING_REBASE_EXPONENT = 512
+# Decayed scores below this are dropped from the ranking
+TRENDING_MIN_SCORE = 0.01
+
+def parse_timestamp(value: str) -> float:
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+class TrendingRanking:
+    def __init__(self, epoch: float):
+        self.epoch = epoch
+        self.scores = {}
+        # (-score, call_id), kept sorted so a page is a slice
+        self.ranked = []
+        self.calls = {}
+
+    def _growth(self, timestamp: float) -> float:
+        return (timestamp - self.epoch) / TRENDING_HALF_LIFE_SECONDS
+
+    def add(self, call_id: str, weight: float, timestamp: float):
+        if self._growth(timestamp) > TRENDING_REBASE_EXPONENT:
+            self.rebase(timestamp)
+        old = self.scores.get(call_id)
+        if old is not None:
+            del self.ranked[bisect.bisect_left(self.ranked, (-old, call_id))]
+        score = (old or 0.0) + weight * 2 ** self._growth(timestamp)
+        self.scores[call_id] = score
+        bisect.insort(self.ranked, (-score, call_id))
+
+    def rebase(self, epoch: float):
+        # Scaling every score by the same factor keeps the order intact
+        factor = 2 ** -((epoch - self.epoch) / TRENDING_HALF_LIFE_SECONDS)
+        self.scores = {call_id: score * factor for call_id, score in self.scores.items()}
+        self.ranked = [(negated * factor, call_id) for negated, call_id in self.ranked]
+        self.epoch = epoch
+
+    def decayed(self, score: float, now: float) -> float:
+        return score * 2 ** -self._growth(now)
+
+    def prune(self, now: float):
+        # Everything below the cutoff sits at the tail of the ranking
+        cutoff = TRENDING_MIN_SCORE * 2 ** self._growth(now)
+        while self.ranked and -self.ranked[-1][0] < cutoff:
+            _, call_id = self.ranked.pop()
+            del self.scores[call_id]
+            self.calls.pop(call_id, None)
+
+    def page(self, offset: int, limit: int, now: float) -> list:
+        return [
+            dict(self.calls.get(call_id, {"id": call_id}), trending_score=self.decayed(-negated, now))
+            for negated, call_id in self.ranked[offset:offset + limit]
+        ]
+
+trending = TrendingRanking(time.time())
+# Per interaction table: (created_at, id) of the newest row folded in. Rows are read in that order,
+# so the pair is a keyset cursor: rows sharing a timestamp are neither skipped nor read twice.
+trending_watermarks: dict = {}
+
+async def fetch_new_interactions(table: str) -> list:
+    since, after_id = trending_watermarks.get(table, (None, None))
+    rows = []
+    while True:
+        query = supabase.table(table).select("id, call_id, created_at")
+        if after_id is None:
+            if since is None:
+                since = datetime.fromtimestamp(time.time() - TRENDING_WINDOW_SECONDS, timezone.utc).isoformat()
+            query = query.gte("created_at", since)
+        else:
+            query = query.or_(f'created_at.gt."{since}",and(created_at.eq."{since}",id.gt."{after_id}")')
+        page = (await run_upstream(query.order("created_at").order("id").limit(FETCH_PAGE_SIZE).execute)).data or []
+        rows.extend(page)
+        if page:
+            since, after_id = page[-1]["created_at"], page[-1]["id"]
+        if len(page) < FETCH_PAGE_SIZE:
+            break
+    trending_watermarks[table] = (since, after_id)
+    return rows
+
+async def refresh_trending():
+    touched = set()
+    for table, weight in TRENDING_WEIGHTS.items():
+        for row in await fetch_new_interactions(table):
+            trending.add(row["call_id"], weight, parse_timestamp(row["created_at"]))
+            touched.add(row["call_id"])
+    trending.prune(time.time())
+
+    # Keep the call rows next to their scores so serving a page never goes upstream
+    missing = [call_id for call_id in touched if call_id in trending.scores and call_id not in trending.calls]
+    for start in range(0, len(missing), FETCH_PAGE_SIZE):
+        batch = missing[start:start + FETCH_PAGE_SIZE]
+        response = await run_upstream(supabase.table("calls").select("*").in_("id", batch).execute)
+        for call in response.data or []:
+            trending.calls[call["id"]] = call
+
+async def refresh_trending_periodically():
+    while True:
+        try:
+            await refresh_trending()
+        except Exception:
+            logger.exception("Failed to refresh trending calls")
+        await asyncio.sleep(TRENDING_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def start_trending():
+    asyncio.create_task(refresh_trending_periodically())
+
+# Follow graph: the follows table is the source of truth; reads are served from an in-memory
+# adjacency index where users are interned to dense ints and each user's followers and
+# following are sorted 4-byte int arrays (bisect for membership, merge for intersections).
+FOLLOW_LIST_MAX_PAGE_SIZE = 100
+FOLLOW_STATUS_MAX_USERS = 200
+# Rebuilt from the table periodically (follows written by other workers); a failed load is
+# retried with exponential backoff from FOLLOW_GRAPH_RETRY_SECONDS up to the refresh interval
+FOLLOW_GRAPH_REFRESH_SECONDS = int(os.environ.get("FOLLOW_GRAPH_REFRESH_SECONDS", "300"))
+FOLLOW_GRAPH_RETRY_SECONDS = 1
+
+class FollowGraph:
+    def __init__(self):
+        self.ids = {}
+        self.user_ids = []
+        self.followers = {}
+        self.following = {}
+
+    @classmethod
+    def from_edges(cls, edges: list):
+        # Bulk build: collect, then sort each adjacency once instead of inserting edge by edge
+        graph = cls()
+        followers, following = {}, {}
+        for follower_id, followee_id in edges:
+            a, b = graph._intern(follower_id), graph._intern(followee_id)
+            following.setdefault(a, []).append(b)
+            followers.setdefault(b, []).append(a)
+        graph.following = {node: array("I", sorted(set(adj))) for node, adj in following.items()}
+        graph.followers = {node: array("I", sorted(set(adj))) for node, adj in followers.items()}
+        return graph
+
+    def _intern(self, user_id: str) -> int:
+        node = self.ids.get(user_id)
+        if node is None:
+            node = self.ids[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return node
+
+    @staticmethod
+    def _contains(adjacency, node: int) -> bool:
+        if adjacency is None:
+            return False
+        i = bisect.bisect_left(adjacency, node)
+        return i < len(adjacency) and adjacency[i] == node
+
+    def add(self, follower_id: str, followee_id: str):
+        a, b = self._intern(follower_id), self._intern(followee_id)
+        for adjacency, node, other in ((self.following, a, b), (self.followers, b, a)):
+            nodes = adjacency.setdefault(node, array("I"))
+            i = bisect.bisect_left(nodes, other)
+            if i == len(nodes) or nodes[i] != other:
+                nodes.insert(i, other)
+
+    def remove(self, follower_id: str, followee_id: str):
+        a, b = self.ids.get(follower_id), self.ids.get(followee_id)
+        if a is None or b is None:
+            return
+        for adjacency, node, other in ((self.following, a, b), (self.followers, b, a)):
+            nodes = adjacency.get(node)
+            if self._contains(nodes, other):
+                del nodes[bisect.bisect_left(nodes, other)]
+
+    def is_following(self, follower_id: str, followee_id: str) -> bool:
+        a, b = self.ids.get(follower_id), self.ids.get(followee_id)
+        return a is not None and b is not None and self._contains(self.following.get(a), b)
+
+    def follower_count(self, user_id: str) -> int:
+        return len(self.followers.get(self.ids.get(user_id), ()))
+
+    def following_count(self, user_id: str) -> int:
+        return len(self.following.get(self.ids.get(user_id), ()))
+
+    def page(self, adjacency: dict, user_id: str, offset: int, limit: int) -> list:
+        nodes = adjacency.get(self.ids.get(user_id), ())
+        return [self.user_ids[node] for node in nodes[offset:offset + limit]]
+
+    def mutuals(self, user_id: str):
+        # Users who follow user_id and are followed back: walk the smaller array, binary-search
+        # the larger one with a moving lower bound
+        node = self.ids.get(user_id)
+        a, b = self.following.get(node, ()), self.followers.get(node, ())
+        if len(a) > len(b):
+            a, b = b, a
+        lo = 0
+        for other in a:
+            lo = bisect.bisect_left(b, other, lo)
+            if lo == len(b):
+                return
+            if b[lo] == other:
+                yield self.user_ids[other]
+
+follow_graph: FollowGraph | None = None
+# Follow writes made while the graph is loading, replayed before it is swapped in
+_pending_follows: list | None = None
+
+def build_follow_graph() -> FollowGraph:
+    rows = fetch_all_rows("follows", "id, follower_id, following_id", "id")
+    return FollowGraph.from_edges([(row["follower_id"], row["following_id"]) for row in rows])
+
+async def load_follow_graph():
+    # The graph is built in a worker thread, but the replay and swap happen here on the event
+    # loop, where record_follow runs, so no write can land between them
+    global follow_graph, _pending_follows
+    _pending_follows = []
+    try:
+        graph = await asyncio.to_thread(build_follow_graph)
+        for followed, follower_id, followee_id in _pending_follows:
+            if followed:
+                graph.add(follower_id, followee_id)
+            else:
+                graph.remove(follower_id, followee_id)
+        follow_graph = graph
+    finally:
+        _pending_follows = None
+
+def record_follow(follower_id: str, followee_id: str, followed: bool):
+    if _pending_follows is not None:
+        _pending_follows.append((followed, follower_id, followee_id))
+    if follow_graph is None:
+        return
+    if followed:
+        follow_graph.add(follower_id, followee_id)
+    else:
+        follow_graph.remove(follower_id, followee_id)
+
+def require_follow_graph() -> FollowGraph:
+    if follow_graph is None:
+        raise HTTPException(status_code=503, detail="Follow graph is still loading.")
+    return follow_graph
+
+async def refresh_follow_graph_periodically(loaded: bool):
+    retry = FOLLOW_GRAPH_RETRY_SECONDS
+    while True:
+        await asyncio.sleep(FOLLOW_GRAPH_REFRESH_SECONDS if loaded else retry)
+        try:
+            await load_follow_graph()
+            loaded, retry = True, FOLLOW_GRAPH_RETRY_SECONDS
+        except Exception:
+            logger.exception("Failed to refresh the follow graph")
+            loaded, retry = False, min(retry * 2, FOLLOW_GRAPH_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def start_follow_graph():
+    loaded = False
+    try:
+        await load_follow_graph()
+        loaded = True
+    except Exception:
+        logger.exception("Failed to load the follow graph; retrying in the background")
+    asyncio.create_task(refresh_follow_graph_periodically(loaded))
+
+# Activity notifications: write endpoints only enqueue an event; a background worker resolves
+# who should hear about it and folds it into that user's inbox, aggregating repeated events
+# on the same target ("12 people amplified your call") into a single entry. Entries are persisted
+# to the activities table; memory only holds the ACTIVITY_CACHED_INBOXES most recently used inboxes.
+ACTIVITY_QUEUE_SIZE = 10000
+ACTIVITY_BATCH_SIZE = 500
+ACTIVITY_INBOX_SIZE = 200
+ACTIVITY_RECENT_ACTORS = 3
+ACTIVITY_MAX_PAGE_SIZE = 50
+ACTIVITY_CACHED_INBOXES = 10000
+
+# Created on startup so it belongs to the server's event loop
+activity_queue: asyncio.Queue | None = None
+# user_id -> OrderedDict of (type, call_id) -> entry, most recently updated last; least recently
+# used inboxes are evicted first
+activity_inboxes: OrderedDict = OrderedDict()
+# call_id -> {"user_id", "prompt"}, so repeated events on a call don't look up its owner again
+call_summaries = ReadCache(READ_CACHE_MAX_ENTRIES)
+
+def publish_activity(activity_type: str, actor_id: str, call_id: str = None, recipient_id: str = None):
+    # Never blocks the request: if the worker has fallen this far behind, drop the notification
+    if activity_queue is None:
+        return
+    try:
+        activity_queue.put_nowait({
+            "type": activity_type,
+            "actor_id": actor_id,
+            "call_id": call_id,
+            "recipient_id": recipient_id,
+            "at": time.time(),
+        })
+    except asyncio.QueueFull:
+        logger.warning("Activity queue full; dropping %s event", activity_type)
+
+async def resolve_call_summaries(call_ids: set):
+    missing = [call_id for call_id in call_ids if call_summaries.get(call_id) is None]
+    for start in range(0, len(missing), FETCH_PAGE_SIZE):
+        batch = missing[start:start + FETCH_PAGE_SIZE]
+        response = await run_upstream(supabase.table("calls").select("id, user_id, prompt").in_("id", batch).execute)
+        for call in response.data or []:
+            call_summaries.put(call["id"], {"user_id": call["user_id"], "prompt": call.get("prompt")})
+
+def activity_entry_from_row(row: dict) -> dict:
+    return {
+        "id": row["id"],
+        "type": row["type"],
+        "call_id": row["call_id"],
+        "prompt": row["prompt"],
+        "count": row["count"],
+        "actor_ids": row["actor_ids"] or [],
+        "updated_at": parse_timestamp(row["updated_at"]),
+    }
+
+async def fetch_activity_inbox(user_id: str) -> OrderedDict:
+    query = supabase.table("activities").select("*").eq("recipient_id", user_id)
+    rows = (await run_upstream(query.order("updated_at", desc=True).limit(ACTIVITY_INBOX_SIZE).execute)).data or []
+    entries = (activity_entry_from_row(row) for row in reversed(rows))
+    return OrderedDict(((entry["type"], entry["call_id"]), entry) for entry in entries)
+
+async def load_activity_inboxes(user_ids: set) -> dict:
+    inboxes = {}
+    missing = []
+    for user_id in user_ids:
+        if user_id in activity_inboxes:
+            activity_inboxes.move_to_end(user_id)
+            inboxes[user_id] = activity_inboxes[user_id]
+        else:
+            missing.append(user_id)
+    fetched = await asyncio.gather(*(fetch_activity_inbox(user_id) for user_id in missing))
+    for user_id, inbox in zip(missing, fetched):
+        # Another load may have finished first and already taken deliveries; keep that one
+        inboxes[user_id] = activity_inboxes.setdefault(user_id, inbox)
+        activity_inboxes.move_to_end(user_id)
+    while len(activity_inboxes) > ACTIVITY_CACHED_INBOXES:
+        activity_inboxes.popitem(last=False)
+    return inboxes
+
+def deliver_activity(inbox: OrderedDict, event: dict, prompt: str = None):
+    # Returns the updated entry and any entries pushed out of the inbox
+    key = (event["type"], event["call_id"])
+    entry = inbox.pop(key, None)
+    if entry is None:
+        entry = {"type": event["type"], "call_id": event["call_id"], "prompt": prompt, "count": 0, "actor_ids": []}
+    if event["actor_id"] in entry["actor_ids"]:
+        entry["actor_ids"].remove(event["actor_id"])
+    else:
+        entry["count"] += 1
+    entry["actor_ids"] = [event["actor_id"]] + entry["actor_ids"][:ACTIVITY_RECENT_ACTORS - 1]
+    entry["updated_at"] = event["at"]
+    inbox[key] = entry
+    evicted = []
+    while len(inbox) > ACTIVITY_INBOX_SIZE:
+        evicted.append(inbox.popitem(last=False)[1])
+    return entry, evicted
+
+async def persist_activity(changed: list, evicted: list):
+    rows = [
+        {
+            "recipient_id": recipient_id,
+            "type": entry["type"],
+            "call_id": entry["call_id"],
+            "prompt": entry["prompt"],
+            "count": entry["count"],
+            "actor_ids": entry["actor_ids"],
+            "updated_at": datetime.fromtimestamp(entry["updated_at"], timezone.utc).isoformat(),
+        }
+        for recipient_id, entry in changed
+    ]
+    if rows:
+        response = await run_upstream(
+            supabase.table("activities").upsert(rows, on_conflict="recipient_id,type,call_id").execute
+        )
+        entries = {(recipient_id, entry["type"], entry["call_id"]): entry for recipient_id, entry in changed}
+        for row in response.data or []:
+            entry = entries.get((row["recipient_id"], row["type"], row["call_id"]))
+            if entry is not None:
+                entry["id"] = row["id"]
+    # Entries created and evicted within the same batch were never written
+    evicted_ids = [entry["id"] for entry in evicted if "id" in entry]
+    for start in range(0, len(evicted_ids), FETCH_PAGE_SIZE):
+        await run_upstream(supabase.table("activities").delete().in_("id", evicted_ids[start:start + FETCH_PAGE_SIZE]).execute)
+
+async def process_activity_batch(events: list):
+    await resolve_call_summaries({event["call_id"] for event in events if event["call_id"]})
+    deliveries = []
+    for event in events:
+        recipient_id, prompt = event["recipient_id"], None
+        if event["call_id"]:
+            summary = call_summaries.get(event["call_id"])
+            if summary is None:
+                continue
+            recipient_id, prompt = summary[0]["user_id"], summary[0]["prompt"]
+        if recipient_id and recipient_id != event["actor_id"]:
+            deliveries.append((recipient_id, event, prompt))
+
+    inboxes = await load_activity_inboxes({recipient_id for recipient_id, _, _ in deliveries})
+    changed, evicted = {}, []
+    for recipient_id, event, prompt in deliveries:
+        entry, dropped = deliver_activity(inboxes[recipient_id], event, prompt)
+        changed[(recipient_id, entry["type"], entry["call_id"])] = (recipient_id, entry)
+        evicted.extend(dropped)
+    await persist_activity(
+        [(recipient_id, entry) for recipient_id, entry in changed.values()
+         if inboxes[recipient_id].get((entry["type"], entry["call_id"])) is entry],
+        evicted,
+    )
+
+async def run_activity_worker():
+    while True:
+        events = [await activity_queue.get()]
+        while len(events) < ACTIVITY_BATCH_SIZE and not activity_queue.empty():
+            events.append(activity_queue.get_nowait())
+        try:
+            await process_activity_batch(events)
+        except Exception:
+            logger.exception("Failed to process %d activity events", len(events))
+
+@app.on_event("startup")
+async def start_activity_worker():
+    global activity_queue
+    activity_queue = asyncio.Queue(maxsize=ACTIVITY_QUEUE_SIZE)
+    asyncio.create_task(run_activity_worker())
+
+# Avatar thumbnails. Originals are fetched once per URL, cut down to AVATAR_SIZES and written to a
+# content-addressed disk cache: thumbs/<sha256 of original>/<size>.webp, plus urls/<sha256 of url>
+# pointing at the content hash, so identical images shared by several URLs are stored once.
+# A background sweep expires URL mappings after AVATAR_CACHE_MAX_AGE_SECONDS (so an image replaced
+# at the same URL is eventually refetched) and drops the oldest thumbnails past AVATAR_CACHE_MAX_BYTES.
+AVATAR_CACHE_DIR = os.environ.get("AVATAR_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "avatar_cache"))
+AVATAR_SIZES = (48, 96, 192)
+AVATAR_DEFAULT_SIZE = 96
+AVATAR_MAX_BYTES = 10 * 1024 * 1024
+# A small file can still decode to a huge bitmap, so dimensions are capped separately
+AVATAR_MAX_PIXELS = 4096 * 4096
+AVATAR_FETCH_TIMEOUT_SECONDS = 10
+AVATAR_MAX_AGE_SECONDS = 86400
+AVATAR_MAX_REDIRECTS = 3
+AVATAR_CACHE_MAX_BYTES = int(os.environ.get("AVATAR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+AVATAR_CACHE_MAX_AGE_SECONDS = int(os.environ.get("AVATAR_CACHE_MAX_AGE_SECONDS", str(7 * 86400)))
+AVATAR_CACHE_PRUNE_SECONDS = 3600
+
+# URL hash -> Future for originals currently being fetched, so concurrent misses fetch once
+_avatar_fetches: dict = {}
+
+def avatar_url_path(url_hash: str) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, "urls", url_hash)
+
+def avatar_thumbnail_path(content_hash: str, size: int) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, "thumbs", content_hash, f"{size}.webp")
+
+def write_atomically(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def cached_avatar_content_hash(url_hash: str):
+    try:
+        with open(avatar_url_path(url_hash)) as f:
+            content_hash = f.read().strip()
+    except FileNotFoundError:
+        return None
+    # The thumbnails may have been pruned since the mapping was written
+    if not all(os.path.exists(avatar_thumbnail_path(content_hash, size)) for size in AVATAR_SIZES):
+        return None
+    return content_hash
+
+def resolve_public_address(url: str) -> str:
+    # Avatar URLs are user supplied; don't let them point the server at internal addresses
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("Avatar URL is not a public http(s) URL")
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        raise ValueError("Avatar URL host does not resolve")
+    ips = []
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global:
+            raise ValueError("Avatar URL is not a public http(s) URL")
+        ips.append(ip)
+    return str(ips[0])
+
+def pinned_avatar_request(client: httpx.AsyncClient, url: str) -> httpx.Request:
+    # Connect to the address that was just checked rather than letting the client resolve the
+    # name again, which a rebinding DNS server could answer with an internal address. The Host
+    # header and TLS SNI (and so certificate verification) still use the original hostname.
+    ip = resolve_public_address(url)
+    parsed = urlparse(url)
+    host = f"[{ip}]" if ":" in ip else ip
+    port = f":{parsed.port}" if parsed.port else ""
+    return client.build_request(
+        "GET",
+        parsed._replace(netloc=host + port).geturl(),
+        headers={"Host": parsed.hostname + port},
+        extensions={"sni_hostname": parsed.hostname},
+    )
+
+def write_avatar_thumbnails(original: bytes) -> str:
+    content_hash = hashlib.sha256(original).hexdigest()
+    if all(os.path.exists(avatar_thumbnail_path(content_hash, size)) for size in AVATAR_SIZES):
+        return content_hash
+    with Image.open(io.BytesIO(original)) as image:
+        # Opening only reads the header; refuse oversized images before anything is decoded
+        if image.width * image.height > AVATAR_MAX_PIXELS:
+            raise ValueError("Avatar image dimensions are too large")
+        largest = AVATAR_SIZES[-1]
+        # JPEGs can be decoded straight at a reduced scale; a no-op for other formats
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        # Shrink to about the largest thumbnail before the RGBA copy and the LANCZOS resamples
+        factor = min(image.size) // largest
+        if factor > 1:
+            image = image.reduce(factor)
+        image = image.convert("RGBA")
+        for size in AVATAR_SIZES:
+            buffer = io.BytesIO()
+            ImageOps.fit(image, (size, size), Image.LANCZOS).save(buffer, "WEBP", quality=85)
+            write_atomically(avatar_thumbnail_path(content_hash, size), buffer.getvalue())
+    return content_hash
+
+async def fetch_avatar_original(url: str) -> bytes:
+    async with httpx.AsyncClient(timeout=AVATAR_FETCH_TIMEOUT_SECONDS) as client:
+        # Redirects are followed by hand so every hop is checked and pinned like the first
+        for _ in range(AVATAR_MAX_REDIRECTS + 1):
+            request = await asyncio.to_thread(pinned_avatar_request, client, url)
+            response = await client.send(request, stream=True)
+            try:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers["Location"])
+                    continue
+                response.raise_for_status()
+                chunks, received = [], 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received > AVATAR_MAX_BYTES:
+                        raise ValueError("Avatar image is too large")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+            finally:
+                await response.aclose()
+    raise ValueError("Avatar URL redirects too many times")
+
+async def ensure_avatar_thumbnails(url: str) -> str:
+    url_hash = hashlib.sha256(url.encode()).hexdigest()
+    content_hash = await asyncio.to_thread(cached_avatar_content_hash, url_hash)
+    if content_hash is not None:
+        return content_hash
+
+    fetch = _avatar_fetches.get(url_hash)
+    if fetch is None:
+        async def fetch_and_resize():
+            try:
+                original = await fetch_avatar_original(url)
+                content_hash = await asyncio.to_thread(write_avatar_thumbnails, original)
+                await asyncio.to_thread(write_atomically, avatar_url_path(url_hash), content_hash.encode())
+                return content_hash
+            finally:
+                _avatar_fetches.pop(url_hash, None)
+
+        fetch = _avatar_fetches[url_hash] = asyncio.ensure_future(fetch_and_resize())
+    return await asyncio.shield(fetch)
+
+def prune_avatar_cache():
+    now = time.time()
+    urls_dir = os.path.join(AVATAR_CACHE_DIR, "urls")
+    if os.path.isdir(urls_dir):
+        for entry in os.scandir(urls_dir):
+            if now - entry.stat().st_mtime > AVATAR_CACHE_MAX_AGE_SECONDS:
+                os.remove(entry.path)
+
+    thumbs_dir = os.path.join(AVATAR_CACHE_DIR, "thumbs")
+    if not os.path.isdir(thumbs_dir):
+        return
+    thumbnails = []
+    for entry in os.scandir(thumbs_dir):
+        if entry.is_dir():
+            size = sum(thumbnail.stat().st_size for thumbnail in os.scandir(entry.path))
+            thumbnails.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in thumbnails)
+    for _, size, path in sorted(thumbnails):
+        if total <= AVATAR_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+async def prune_avatar_cache_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(prune_avatar_cache)
+        except Exception:
+            logger.exception("Failed to prune the avatar cache")
+        await asyncio.sleep(AVATAR_CACHE_PRUNE_SECONDS)
+
+@app.on_event("startup")
+async def start_avatar_cache_pruning():
+    asyncio.create_task(prune_avatar_cache_periodically())
+
+async def warm_avatar_thumbnails(url: str):
+    try:
+        await ensure_avatar_thumbnails(url)
+    except Exception:
+        logger.warning("Failed to prepare avatar thumbnails for %s", url, exc_info=True)
+
+async def lookup_avatar_url(user_id: str):
+    if username_index is not None and user_id in username_index.profiles:
+        return username_index.profiles[user_id]["avatar_url"]
+    response = await run_upstream(supabase.table("profiles").select("avatar_url").eq("user_id", user_id).execute)
+    return response.data[0]["avatar_url"] if response.data else None
 
 @app.get("/api/")
 async def read_root():
@@ -53,17 +1568,77 @@ async def read_root():
 async def test_endpoint():
     return {"message": "Test endpoint reached!"}
 
+@app.get("/api/debug/slow-requests")
+async def get_slow_requests(request: Request):
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return {"threshold_ms": SLOW_REQUEST_MS, "requests": list(reversed(slow_requests))}
+
+@app.get("/api/debug/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, request: Request):
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    profile = request_profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    # Folded stacks as plain text, ready for flamegraph.pl or speedscope
+    return Response(content=profile["folded"], media_type="text/plain")
+
+@app.get("/api/metrics")
+async def get_metrics():
+    routes = {
+        key: {
+            "requests": route.requests,
+            "hedges": route.hedges,
+            "hedge_wins": route.hedge_wins,
+            "hedge_rate": route.hedges / route.requests if route.requests else 0.0,
+            "win_rate": route.hedge_wins / route.hedges if route.hedges else 0.0,
+            "p95_ms": route.p95() * 1000 if route.p95() is not None else None,
+        }
+        for key, route in hedged_routes.items()
+    }
+    return {
+        "circuit": supabase_breaker.state,
+        "hedging": {"budget": hedge_budget, "routes": routes},
+    }
+
 @app.get("/api/profiles")
-async def get_profiles():
+async def get_profiles(response: Response):
     try:
-        response = supabase.table("profiles").select("*").execute()
-        if response.data:
-            return {"profiles": response.data}
+        profiles = await cached_read("profiles", fetch_rows(lambda: supabase.table("profiles").select("*"), "profiles"), response)
+        if profiles:
+            return {"profiles": profiles}
         else:
             return {"message": "No profiles found"}
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/api/profiles/username-available")
+async def username_available(username: str):
+    if not username:
+        raise HTTPException(status_code=400, detail="Username is required.")
+
+    # A Bloom filter never reports a false negative, so a miss is a definitive answer
+    if username_filter is not None and username not in username_filter:
+        return {"username": username, "available": True}
+
+    try:
+        response = await run_upstream(supabase.table("profiles").select("user_id").eq("username", username).limit(1).execute)
+        return {"username": username, "available": not response.data}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred while checking username availability: {str(e)}")
+
+@app.get("/api/autocomplete")
+async def autocomplete_usernames(prefix: str, limit: int = 10):
+    # Accept mention-style prefixes ("@jan") as well as bare ones
+    prefix = prefix.lstrip("@")
+    if not prefix:
+        return {"prefix": prefix, "profiles": []}
+    if username_index is None:
+        raise HTTPException(status_code=503, detail="Autocomplete index is still loading.")
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+    return {"prefix": prefix, "profiles": username_index.search(prefix, limit)}
+
 @app.get("/api/auth/google/login")
 async def google_login_url():
     try:
@@ -100,7 +1675,9 @@ async def google_callback(request: Request):
             raise HTTPException(status_code=400, detail="Authorization code not found in callback.")
 
         # Exchange the authorization code for a session
-        session_response = supabase.auth.exchange_code_for_session({"auth_code": code})
+        session_response = await run_upstream(
+            lambda: supabase.auth.exchange_code_for_session({"auth_code": code}), label="auth exchange_code_for_session"
+        )
 
         if session_response.session:
             session = session_response.session
@@ -110,7 +1687,7 @@ async def google_callback(request: Request):
             from fastapi.responses import RedirectResponse
             
             # Check if a profile already exists for this user
-            existing_profile = supabase.table("profiles").select("user_id").eq("user_id", user.id).execute()
+            existing_profile = await run_upstream(supabase.table("profiles").select("user_id").eq("user_id", user.id).execute)
 
             if existing_profile.data:
                 # Profile exists, redirect to feed
@@ -122,14 +1699,7 @@ async def google_callback(request: Request):
             response = RedirectResponse(url=redirect_url)
             
             # Set cookies for the session
-            response.set_cookie(
-                key="sb-access-token", value=session.access_token, httponly=True, samesite="lax",
-                secure=False, max_age=session.expires_in
-            )
-            response.set_cookie(
-                key="sb-refresh-token", value=session.refresh_token, httponly=True, samesite="lax",
-                secure=False, max_age=604800
-            )
+            set_session_cookies(response, session)
             
             return response
         elif session_response.error:
@@ -159,12 +1729,12 @@ async def create_profile(
     
     try:
         # Check if a profile already exists for this user_id
-        existing_profile_by_user_id = supabase.table("profiles").select("*").eq("user_id", user_id).execute()
+        existing_profile_by_user_id = await run_upstream(supabase.table("profiles").select("*").eq("user_id", user_id).execute)
         if existing_profile_by_user_id.data:
             raise HTTPException(status_code=409, detail="Profile already exists for this user.")
 
         # Check if the username is already taken
-        existing_profile_by_username = supabase.table("profiles").select("*").eq("username", username).execute()
+        existing_profile_by_username = await run_upstream(supabase.table("profiles").select("*").eq("username", username).execute)
         if existing_profile_by_username.data:
             raise HTTPException(status_code=409, detail="Username already taken. Please choose a different one.")
 
@@ -174,9 +1744,11 @@ async def create_profile(
             "bio": bio,
             "avatar_url": avatar_url
         }
-        response = supabase.table("profiles").insert(profile_data).execute()
+        response = await run_upstream(supabase.table("profiles").insert(profile_data).execute)
 
         if response.data:
+            index_profile(response.data[0])
+            read_cache.invalidate("profiles")
             return {"message": "Profile created successfully", "profile": response.data[0]}
         elif response.error:
             raise HTTPException(status_code=400, detail=response.error.get("message", "Error creating profile"))
@@ -192,7 +1764,7 @@ async def get_profile(user_id: str, current_user_id: str = Depends(get_current_u
     # For simplicity, let's allow fetching any profile, but if it were restricted,
     # we'd add a check here like: if user_id != current_user_id: raise HTTPException(status_code=403, detail="Forbidden")
     try:
-        response = supabase.table("profiles").select("*").eq("user_id", user_id).execute()
+        response = await run_upstream(supabase.table("profiles").select("*").eq("user_id", user_id).execute)
         if response.data:
             return {"profile": response.data[0]}
         else:
@@ -208,9 +1780,9 @@ async def update_profile(
     username: str = None,
     bio: str = None,
     avatar_url: str = None,
-    current_user_id: str = Depends(get_current_user)
+    current_user: User = Depends(get_current_user)
 ):
-    if user_id != current_user_id:
+    if user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Forbidden: User ID mismatch")
     
     try:
@@ -225,9 +1797,14 @@ async def update_profile(
         if not update_data:
             raise HTTPException(status_code=400, detail="No update data provided.")
 
-        response = supabase.table("profiles").update(update_data).eq("user_id", user_id).execute()
+        response = await run_upstream(supabase.table("profiles").update(update_data).eq("user_id", user_id).execute)
 
         if response.data:
+            index_profile(response.data[0])
+            read_cache.invalidate("profiles")
+            if avatar_url:
+                # Have the thumbnails ready before the first feed card asks for them
+                asyncio.create_task(warm_avatar_thumbnails(avatar_url))
             return {"message": "Profile updated successfully", "profile": response.data[0]}
         elif response.error:
             if "The row with the given key does not exist." in response.error.get("message", ""):
@@ -240,13 +1817,110 @@ async def update_profile(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An internal error occurred during profile update: {str(e)}")
 
+@app.get("/api/avatars/{user_id}")
+async def get_avatar(user_id: str, request: Request, size: int = AVATAR_DEFAULT_SIZE):
+    # Snap to the smallest standard size that is at least as large as requested
+    size = next((standard for standard in AVATAR_SIZES if standard >= size), AVATAR_SIZES[-1])
+    try:
+        avatar_url = await lookup_avatar_url(user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred while fetching avatar: {str(e)}")
+    if not avatar_url:
+        raise HTTPException(status_code=404, detail="This user has no avatar.")
+
+    try:
+        content_hash = await ensure_avatar_thumbnails(avatar_url)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Could not load the avatar image: {str(e)}")
+
+    etag = f'"{content_hash}-{size}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={AVATAR_MAX_AGE_SECONDS}, stale-while-revalidate={AVATAR_MAX_AGE_SECONDS * 7}",
+    }
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    # FileResponse hands the path to the server (http.response.pathsend) for sendfile where supported
+    return FileResponse(avatar_thumbnail_path(content_hash, size), media_type="image/webp", headers=headers)
+
+@app.post("/api/profiles/{user_id}/follow")
+async def follow_user(user_id: str, current_user: User = Depends(get_current_user)):
+    if user_id == current_user.id:
+        raise HTTPException(status_code=400, detail="You cannot follow yourself.")
+    graph = require_follow_graph()
+    if graph.is_following(current_user.id, user_id):
+        return {"message": "Already following", "following": True, "followers_count": graph.follower_count(user_id)}
+
+    try:
+        follow_data = {"follower_id": current_user.id, "following_id": user_id}
+        await run_upstream(supabase.table("follows").upsert(follow_data, on_conflict="follower_id,following_id").execute)
+        record_follow(current_user.id, user_id, True)
+        publish_activity("follow", current_user.id, recipient_id=user_id)
+        return {"message": "User followed successfully", "following": True, "followers_count": graph.follower_count(user_id)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during follow: {str(e)}")
+
+@app.delete("/api/profiles/{user_id}/follow")
+async def unfollow_user(user_id: str, current_user: User = Depends(get_current_user)):
+    graph = require_follow_graph()
+    try:
+        await run_upstream(
+            supabase.table("follows").delete().eq("follower_id", current_user.id).eq("following_id", user_id).execute
+        )
+        record_follow(current_user.id, user_id, False)
+        return {"message": "User unfollowed successfully", "following": False, "followers_count": graph.follower_count(user_id)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during unfollow: {str(e)}")
+
+@app.get("/api/profiles/{user_id}/followers")
+async def get_followers(user_id: str, offset: int = 0, limit: int = 50, current_user: User = Depends(get_current_user)):
+    graph = require_follow_graph()
+    offset, limit = max(0, offset), max(1, min(limit, FOLLOW_LIST_MAX_PAGE_SIZE))
+    return {
+        "followers": graph.page(graph.followers, user_id, offset, limit),
+        "count": graph.follower_count(user_id),
+        "offset": offset,
+        "limit": limit,
+    }
+
+@app.get("/api/profiles/{user_id}/following")
+async def get_following(user_id: str, offset: int = 0, limit: int = 50, current_user: User = Depends(get_current_user)):
+    graph = require_follow_graph()
+    offset, limit = max(0, offset), max(1, min(limit, FOLLOW_LIST_MAX_PAGE_SIZE))
+    return {
+        "following": graph.page(graph.following, user_id, offset, limit),
+        "count": graph.following_count(user_id),
+        "offset": offset,
+        "limit": limit,
+    }
+
+@app.get("/api/profiles/{user_id}/mutuals")
+async def get_mutuals(user_id: str, offset: int = 0, limit: int = 50, current_user: User = Depends(get_current_user)):
+    graph = require_follow_graph()
+    offset, limit = max(0, offset), max(1, min(limit, FOLLOW_LIST_MAX_PAGE_SIZE))
+    mutuals = list(itertools.islice(graph.mutuals(user_id), offset, offset + limit))
+    return {"mutuals": mutuals, "offset": offset, "limit": limit}
+
+@app.get("/api/follows/status")
+async def get_follow_status(user_ids: str, current_user: User = Depends(get_current_user)):
+    # One call for a whole page of FollowButtons: user_ids is a comma-separated list
+    graph = require_follow_graph()
+    ids = [user_id for user_id in user_ids.split(",") if user_id][:FOLLOW_STATUS_MAX_USERS]
+    return {
+        user_id: {
+            "following": graph.is_following(current_user.id, user_id),
+            "followers_count": graph.follower_count(user_id),
+        }
+        for user_id in ids
+    }
+
 @app.post("/api/calls")
 async def create_call(
     user_id: str,
     prompt: str,
-    current_user_id: str = Depends(get_current_user)
+    current_user: User = Depends(get_current_user)
 ):
-    if user_id != current_user_id:
+    if user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Forbidden: User ID mismatch")
     
     try:
@@ -254,9 +1928,12 @@ async def create_call(
             "user_id": user_id,
             "prompt": prompt
         }
-        response = supabase.table("calls").insert(call_data).execute()
+        response = await run_upstream(supabase.table("calls").insert(call_data).execute)
 
         if response.data:
+            if username_index is not None:
+                username_index.bump(user_id)
+            read_cache.invalidate(f"calls:{user_id}")
             return {"message": "Call created successfully", "call": response.data[0]}
         elif response.error:
             raise HTTPException(status_code=400, detail=response.error.get("message", "Error creating call"))
@@ -267,15 +1944,53 @@ async def create_call(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An internal error occurred during call creation: {str(e)}")
 
+@app.get("/api/activity")
+async def get_activity(offset: int = 0, limit: int = 20, current_user: User = Depends(get_current_user)):
+    offset = max(0, offset)
+    limit = max(1, min(limit, ACTIVITY_MAX_PAGE_SIZE))
+    try:
+        inbox = (await load_activity_inboxes({current_user.id}))[current_user.id]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred while fetching activity: {str(e)}")
+    entries = list(itertools.islice(reversed(inbox.values()), offset, offset + limit))
+    profiles = username_index.profiles if username_index is not None else {}
+    return {
+        "activities": [
+            dict(
+                entry,
+                actors=[profiles.get(actor_id, {"user_id": actor_id}) for actor_id in entry["actor_ids"]],
+            )
+            for entry in entries
+        ],
+        "offset": offset,
+        "limit": limit,
+        "total": len(inbox),
+    }
+
+@app.get("/api/calls/trending")
+async def get_trending_calls(offset: int = 0, limit: int = 20, current_user: User = Depends(get_current_user)):
+    offset = max(0, offset)
+    limit = max(1, min(limit, TRENDING_MAX_PAGE_SIZE))
+    return {
+        "calls": trending.page(offset, limit, time.time()),
+        "offset": offset,
+        "limit": limit,
+        "total": len(trending.ranked),
+    }
+
 @app.get("/api/calls")
-async def get_calls(current_user_id: str = Depends(get_current_user)):
+async def get_calls(response: Response, current_user: User = Depends(get_current_user)):
     # Assuming calls are only visible to logged-in users
     # If calls are public, this dependency might be removed or adjusted
     try:
         # Fetch calls associated with the current user
-        response = supabase.table("calls").select("*").eq("user_id", current_user_id).execute()
-        if response.data:
-            return {"calls": response.data}
+        calls = await cached_read(
+            f"calls:{current_user.id}",
+            fetch_rows(lambda: supabase.table("calls").select("*").eq("user_id", current_user.id), "calls"),
+            response,
+        )
+        if calls:
+            return {"calls": calls}
         else:
             return {"message": "No calls found for this user"}
     except Exception as e:
@@ -286,9 +2001,9 @@ async def create_response(
     call_id: str,
     user_id: str,
     response_text: str,
-    current_user_id: str = Depends(get_current_user)
+    current_user: User = Depends(get_current_user)
 ):
-    if user_id != current_user_id:
+    if user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Forbidden: User ID mismatch")
     
     try:
@@ -297,9 +2012,11 @@ async def create_response(
             "user_id": user_id,
             "response_text": response_text
         }
-        response = supabase.table("responses").insert(response_data).execute()
+        response = await run_upstream(supabase.table("responses").insert(response_data).execute)
 
         if response.data:
+            read_cache.invalidate("responses:")
+            publish_activity("reply", user_id, call_id=call_id)
             return {"message": "Response created successfully", "response": response.data[0]}
         elif response.error:
             raise HTTPException(status_code=400, detail=response.error.get("message", "Error creating response"))
@@ -311,31 +2028,31 @@ async def create_response(
         raise HTTPException(status_code=500, detail=f"An internal error occurred during response creation: {str(e)}")
 
 @app.get("/api/responses")
-async def get_responses(call_id: str = None, user_id: str = None, current_user_id: str = Depends(get_current_user)):
+async def get_responses(response: Response, call_id: str = None, user_id: str = None, current_user: User = Depends(get_current_user)):
     # If filtering by user_id, ensure it matches the current user
-    if user_id and user_id != current_user_id:
+    if user_id and user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Forbidden: User ID mismatch")
     
     # If no filters are provided, or if filtering by current_user_id, fetch accordingly
-    try:
+    # If user_id is provided and matches current_user_id, filter by it.
+    # Otherwise, if user_id is not provided, we might want to fetch responses for the current user.
+    # Let's assume for now that if user_id is not specified, we fetch for the current user.
+    # If call_id is specified, we fetch responses for that call, potentially filtered by current user.
+    if not user_id and not call_id:
+        user_id = current_user.id
+
+    def build_query():
         query = supabase.table("responses").select("*")
         if call_id:
             query = query.eq("call_id", call_id)
-        
-        # If user_id is provided and matches current_user_id, filter by it.
-        # Otherwise, if user_id is not provided, we might want to fetch responses for the current user.
-        # Let's assume for now that if user_id is not specified, we fetch for the current user.
-        # If call_id is specified, we fetch responses for that call, potentially filtered by current user.
-        
-        if user_id: # This will be current_user_id due to the check above
+        if user_id:
             query = query.eq("user_id", user_id)
-        elif not call_id: # If no call_id and no user_id specified, fetch for current user
-             query = query.eq("user_id", current_user_id)
+        return query
 
-        response = query.execute()
-
-        if response.data:
-            return {"responses": response.data}
+    try:
+        responses = await cached_read(f"responses:{call_id or ''}:{user_id or ''}", fetch_rows(build_query, "responses"), response)
+        if responses:
+            return {"responses": responses}
         else:
             return {"message": "No responses found"}
     except Exception as e:
@@ -346,9 +2063,9 @@ async def create_echo(
     call_id: str,
     response_id: str,
     user_id: str,
-    current_user_id: str = Depends(get_current_user)
+    current_user: User = Depends(get_current_user)
 ):
-    if user_id != current_user_id:
+    if user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Forbidden: User ID mismatch")
     
     try:
@@ -357,9 +2074,10 @@ async def create_echo(
             "response_id": response_id,
             "user_id": user_id
         }
-        response = supabase.table("echoes").insert(echo_data).execute()
+        response = await run_upstream(supabase.table("echoes").insert(echo_data).execute)
 
         if response.data:
+            publish_activity("echo", user_id, call_id=call_id)
             return {"message": "Echo created successfully", "echo": response.data[0]}
         elif response.error:
             raise HTTPException(status_code=400, detail=response.error.get("message", "Error creating echo"))
@@ -386,7 +2104,7 @@ async def get_echoes(call_id: str = None, response_id: str = None, user_id: str
         if user_id:
             query = query.eq("user_id", user_id)
 
-        response = query.execute()
+        response = await run_upstream(query.execute)
 
         if response.data:
             return {"echoes": response.data}
@@ -396,24 +2114,25 @@ async def get_echoes(call_id: str = None, response_id: str = None, user_id: str
         return {"error": str(e)}
 
 @app.post("/api/calls/{post_id}/amplify")
-async def amplify_call(post_id: str, current_user_id: str = Depends(get_current_user)):
+async def amplify_call(post_id: str, current_user: User = Depends(get_current_user)):
     try:
         # Check if already amplified
-        existing_amplify = supabase.table("amplifies").select("*").eq("call_id", post_id).eq("user_id", current_user_id).execute()
+        existing_amplify = await run_upstream(supabase.table("amplifies").select("*").eq("call_id", post_id).eq("user_id", current_user.id).execute)
         
         if existing_amplify.data:
             # If already amplified, remove amplify (toggle)
-            supabase.table("amplifies").delete().eq("call_id", post_id).eq("user_id", current_user_id).execute()
+            await run_upstream(supabase.table("amplifies").delete().eq("call_id", post_id).eq("user_id", current_user.id).execute)
             return {"message": "Amplify removed", "amplified": False}
         else:
             # Add amplify
             amplify_data = {
                 "call_id": post_id,
-                "user_id": current_user_id
+                "user_id": current_user.id
             }
-            response = supabase.table("amplifies").insert(amplify_data).execute()
+            response = await run_upstream(supabase.table("amplifies").insert(amplify_data).execute)
             
             if response.data:
+                publish_activity("amplify", current_user.id, call_id=post_id)
                 return {"message": "Call amplified successfully", "amplified": True}
             else:
                 raise HTTPException(status_code=400, detail="Failed to amplify call")
@@ -421,22 +2140,22 @@ async def amplify_call(post_id: str, current_user_id: str = Depends(get_current_
         raise HTTPException(status_code=500, detail=f"An error occurred during amplify: {str(e)}")
 
 @app.post("/api/calls/{post_id}/bookmark")
-async def bookmark_call(post_id: str, current_user_id: str = Depends(get_current_user)):
+async def bookmark_call(post_id: str, current_user: User = Depends(get_current_user)):
     try:
         # Check if already bookmarked
-        existing_bookmark = supabase.table("bookmarks").select("*").eq("call_id", post_id).eq("user_id", current_user_id).execute()
+        existing_bookmark = await run_upstream(supabase.table("bookmarks").select("*").eq("call_id", post_id).eq("user_id", current_user.id).execute)
         
         if existing_bookmark.data:
             # If already bookmarked, remove bookmark (toggle)
-            supabase.table("bookmarks").delete().eq("call_id", post_id).eq("user_id", current_user_id).execute()
+            await run_upstream(supabase.table("bookmarks").delete().eq("call_id", post_id).eq("user_id", current_user.id).execute)
             return {"message": "Bookmark removed", "bookmarked": False}
         else:
             # Add bookmark
             bookmark_data = {
                 "call_id": post_id,
-                "user_id": current_user_id
+                "user_id": current_user.id
             }
-            response = supabase.table("bookmarks").insert(bookmark_data).execute()
+            response = await run_upstream(supabase.table("bookmarks").insert(bookmark_data).execute)
             
             if response.data:
                 return {"message": "Call bookmarked successfully", "bookmarked": True}
@@ -445,6 +2164,44 @@ async def bookmark_call(post_id: str, current_user_id: str = Depends(get_current
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during bookmark: {str(e)}")
 
+EXPORT_TABLES = [("calls", "call"), ("responses", "response"), ("echoes", "echo"), ("amplifies", "amplify"), ("bookmarks", "bookmark")]
+EXPORT_PAGE_SIZE = 500
+
+async def fetch_export_page(table: str, user_id: str, after_id):
+    query = supabase.table(table).select("*").eq("user_id", user_id).order("id").limit(EXPORT_PAGE_SIZE)
+    if after_id is not None:
+        query = query.gt("id", after_id)
+    return (await run_upstream(query.execute)).data or []
+
+async def stream_user_export(user_id: str):
+    profile = await run_upstream(supabase.table("profiles").select("*").eq("user_id", user_id).execute)
+    for row in profile.data or []:
+        yield json.dumps({"type": "profile", "data": row}, default=str) + "\n"
+
+    for table, record_type in EXPORT_TABLES:
+        # Keyset pages, with the next page requested while the current one is being sent, so
+        # only two pages are ever held in memory and the upstream round trip overlaps the network
+        next_page = asyncio.ensure_future(fetch_export_page(table, user_id, None))
+        while next_page is not None:
+            page = await next_page
+            next_page = None
+            if len(page) == EXPORT_PAGE_SIZE:
+                next_page = asyncio.ensure_future(fetch_export_page(table, user_id, page[-1]["id"]))
+            try:
+                yield "".join(json.dumps({"type": record_type, "data": row}, default=str) + "\n" for row in page)
+            except BaseException:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+@app.get("/api/export")
+async def export_user_data(current_user: User = Depends(get_current_user)):
+    return StreamingResponse(
+        stream_user_export(current_user.id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="glich-export-{current_user.id}.ndjson"'},
+    )
+
 @app.post("/api/auth/logout")
 async def logout(response: Response):
     response.delete_cookie(key="sb-access-token")
@@ -455,10 +2212,10 @@ async def logout(response: Response):
 async def search_content(query: str, current_user_id: str = Depends(get_current_user)):
     try:
         # Search in calls (posts)
-        calls_response = supabase.table("calls").select("*").ilike("prompt", f"%{query}%").execute()
+        calls_response = await run_upstream(supabase.table("calls").select("*").ilike("prompt", f"%{query}%").execute)
         
         # Search in profiles
-        profiles_response = supabase.table("profiles").select("*").ilike("username", f"%{query}%").execute()
+        profiles_response = await run_upstream(supabase.table("profiles").select("*").ilike("username", f"%{query}%").execute)
         
         return {
             "calls": calls_response.data or [],
@@ -472,16 +2229,16 @@ async def search_content(query: str, current_user_id: str = Depends(get_current_
 async def get_call_interactions(post_id: str, current_user_id: str = Depends(get_current_user)):
     try:
         # Get responses count
-        responses = supabase.table("responses").select("*").eq("call_id", post_id).execute()
+        responses = await run_upstream(supabase.table("responses").select("*").eq("call_id", post_id).execute)
         
         # Get echoes count
-        echoes = supabase.table("echoes").select("*").eq("call_id", post_id).execute()
+        echoes = await run_upstream(supabase.table("echoes").select("*").eq("call_id", post_id).execute)
         
         # Get amplifies count
-        amplifies = supabase.table("amplifies").select("*").eq("call_id", post_id).execute()
+        amplifies = await run_upstream(supabase.table("amplifies").select("*").eq("call_id", post_id).execute)
         
         # Get bookmarks count
-        bookmarks = supabase.table("bookmarks").select("*").eq("call_id", post_id).execute()
+        bookmarks = await run_upstream(supabase.table("bookmarks").select("*").eq("call_id", post_id).execute)
         
         # Check if current user has interacted
         user_amplified = any(amp["user_id"] == current_user_id for amp in (amplifies.data or []))
@@ -0,0 +1,27 @@
+-- Follow graph (served from the in-memory index in backend/server.py)
+CREATE TABLE IF NOT EXISTS public.follows (
+  id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  follower_id UUID NOT NULL REFERENCES auth.users (id) ON DELETE CASCADE,
+  following_id UUID NOT NULL REFERENCES auth.users (id) ON DELETE CASCADE,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  UNIQUE (follower_id, following_id),
+  CHECK (follower_id <> following_id)
+);
+
+CREATE INDEX IF NOT EXISTS follows_following_id_idx ON public.follows (following_id);
+
+-- Aggregated activity notifications (recently used inboxes are cached in backend/server.py)
+CREATE TABLE IF NOT EXISTS public.activities (
+  id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  recipient_id UUID NOT NULL REFERENCES auth.users (id) ON DELETE CASCADE,
+  type TEXT NOT NULL,
+  call_id TEXT,
+  prompt TEXT,
+  count INTEGER NOT NULL DEFAULT 1,
+  actor_ids UUID[] NOT NULL DEFAULT '{}',
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  -- Follow notifications have no call; NULLS NOT DISTINCT keeps them to one row per recipient
+  UNIQUE NULLS NOT DISTINCT (recipient_id, type, call_id)
+);
+
+CREATE INDEX IF NOT EXISTS activities_recipient_id_updated_at_idx ON public.activities (recipient_id, updated_at DESC);